@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import pathlib
 import tempfile
 import traceback
 import unittest
@@ -9,6 +10,7 @@ import yamlet
 
 from contextlib import contextmanager
 from ruamel.yaml.constructor import ConstructorError
+from ruamel.yaml.main import CParser
 
 def ParameterizedOnOpts(klass):
   YO = yamlet.YamletOptions
@@ -55,6 +57,23 @@ ParameterizedForStress = (
 
 @ParameterizedOnOpts
 class TestTupleCompositing(unittest.TestCase):
+  def test_plain_and_nested_overrides_keep_order(self):
+    YAMLET = '''# Yamlet
+    t1:
+      a: 1
+      b: 2
+      n: { x: 1 }
+      c: 3
+    t2: !expr |
+        t1 { e: 5, b: 20, n: { y: 2 }, c: 30, d: 4 }
+    '''
+    loader = yamlet.Loader(self.Opts())
+    y = loader.load(YAMLET)
+    self.assertEqual(list(y['t2'].keys()), ['a', 'b', 'n', 'c', 'e', 'd'])
+    self.assertEqual(y['t2']['b'], 20)
+    self.assertEqual(y['t2']['c'], 30)
+    self.assertEqual(y['t2']['n'].evaluate_fully(), {'x': 1, 'y': 2})
+
   def test_composited_fields(self):
     YAMLET = '''# Yamlet
     t1:
@@ -223,6 +242,54 @@ class TestTupleCompositing(unittest.TestCase):
     y = loader.load(YAMLET)
     self.assertEqual(y['t2']['sub']['deferred'], 'Hello, world!')
 
+  def test_composite_sequence_of_non_tuples(self):
+    YAMLET = '''# YAMLET
+    t1:
+      a: 10
+    t2: !composite
+      - t1
+      - 1234
+    '''
+    loader = yamlet.Loader(self.Opts())
+    y = loader.load(YAMLET)
+    with AssertRaisesCleanException(self, TypeError):
+      val = y['t2']
+      self.fail(f'Did not throw an exception; got `{val}`')
+
+  def test_composite_of_one_tuple_is_a_copy(self):
+    YAMLET = '''# YAMLET
+    t1:
+      a: 1
+    t2: !composite [t1]
+    '''
+    loader = yamlet.Loader(self.Opts())
+    y = loader.load(YAMLET)
+    t2 = y['t2']
+    t2['a'] = 5
+    self.assertEqual((y['t1']['a'], t2['a']), (1, 5))
+
+  def test_overriding_with_plain_values(self):
+    YAMLET = '''# YAMLET
+    t1:
+      a: !expr b + 1
+      b: 10
+      c:
+        ca: nested
+      d: !fmt '{b}'
+    t2: !composite
+      - t1
+      - {a: plain, c: 30}
+      - {c: 40}
+    '''
+    loader = yamlet.Loader(self.Opts())
+    y = loader.load(YAMLET)
+    self.assertEqual(list(y['t2'].keys()), ['a', 'b', 'c', 'd'])
+    self.assertEqual(y['t2']['a'], 'plain')
+    self.assertEqual(y['t2']['c'], 40)
+    self.assertEqual(y['t2']['d'], '10')
+    self.assertEqual(y['t1']['a'], 11)
+    self.assertEqual(y['t1']['c']['ca'], 'nested')
+
   def test_compositing_in_parenths(self):
     YAMLET = '''# YAMLET
     t1:
@@ -390,6 +457,138 @@ class TestValueMechanics(unittest.TestCase):
     y = loader.load(YAMLET)
     self.assertEqual(y['v3'], '{Hello}, {{world}}{s}!')
 
+  def test_fmt_without_substitutions(self):
+    YAMLET = '''# Yamlet
+    t:
+      plain: !fmt Hello, world!
+      empty: !fmt ''
+    t2: !expr |
+        t { plain: 'Goodbye' }
+    '''
+    loader = yamlet.Loader(self.Opts())
+    y = loader.load(YAMLET)
+    self.assertEqual(y['t']['plain'], 'Hello, world!')
+    self.assertEqual(y['t']['empty'], '')
+    self.assertEqual(y['t2']['plain'], 'Goodbye')
+
+  def test_fmt_keys_are_rejected(self):
+    loader = yamlet.Loader(self.Opts())
+    for key in ('abc', "'{x}'"):
+      with self.assertRaisesRegex(ConstructorError,
+                                  'keys from YAML mappings must be constant'):
+        loader.load(f'# Yamlet\nt:\n  x: 1\n  !fmt {key}: 1\n')
+
+  def test_constant_values_survive_cloning(self):
+    YAMLET = '''# Yamlet
+    t:
+      n: !expr 6 * 7
+      l: !expr '[1, 2]'
+    t2: !expr |
+        t { m: 1 }
+    '''
+    loader = yamlet.Loader(self.Opts())
+    y = loader.load(YAMLET)
+    self.assertEqual(y['t']['n'], 42)
+    self.assertEqual(y['t']['l'], [1, 2])
+    self.assertEqual(y['t2']['n'], 42)
+    self.assertEqual(y['t2']['l'], [1, 2])
+    self.assertIsNot(y['t2']['l'], y['t']['l'])
+
+  def test_unevaluated_literal_values_print_as_source(self):
+    YAMLET = '''# Yamlet
+    b: 2
+    t: !expr |
+      {x: b + 1}
+    '''
+    loader = yamlet.Loader(self.Opts())
+    y = loader.load(YAMLET)
+    t = y['t']
+    self.assertIn("ParsedExpressionToEvaluate('b + 1'", repr(t))
+    self.assertNotIn('ast.', str(t))
+    self.assertEqual(t['x'], 3)
+
+  def test_explain_plain_lookups(self):
+    YAMLET = '''# Yamlet
+    a: 1
+    c: 2
+    b: !expr a + c
+    '''
+    loader = yamlet.Loader(self.Opts())
+    y = loader.load(YAMLET)
+    self.assertEqual(y['b'], 3)
+    explanation = y.explain_value('b')
+    self.assertIn('With lookup of `a`', explanation)
+    self.assertIn('With lookup of `c`', explanation)
+
+  def test_yaml_set(self):
+    YAMLET = '''# Yamlet
+    s: !!set {a, b}
+    '''
+    loader = yamlet.Loader(self.Opts())
+    y = loader.load(YAMLET)
+    self.assertEqual(y['s'], {'a', 'b'})
+
+  @unittest.skipIf(CParser is None, 'ruamel.yaml.clib is not installed')
+  def test_libyaml_parser(self):
+    YAMLET = '''# Yamlet
+    t:
+      a: 2
+      b: !expr a * 3
+      c: !fmt '{a}{b}'
+      !if b > 5:
+        d: big
+      !else:
+        d: small
+    t2: !expr |
+        t { a: 1 }
+    '''
+    loader = yamlet.Loader(self.Opts(libyaml=True))
+    self.assertIs(loader.Parser, CParser)
+    y = loader.load(YAMLET)
+    self.assertEqual(y['t']['c'], '26')
+    self.assertEqual(y['t']['d'], 'big')
+    self.assertEqual(y['t2']['d'], 'small')
+
+  def test_composite_expression_with_leading_space(self):
+    YAMLET = '''# Yamlet
+    t:
+      a: 1
+    t2: !expr '  t { a: 2 }'
+    '''
+    loader = yamlet.Loader(self.Opts())
+    y = loader.load(YAMLET)
+    self.assertEqual(y['t2']['a'], 2)
+
+  def test_lookup_after_mutation(self):
+    def Load(mid_v):
+      return yamlet.Loader(self.Opts()).load(f'''# Yamlet
+    t:
+      v: outer
+      mid:
+        sub:
+          a: !expr v
+          b: !expr v
+        {mid_v}
+    ''')
+    def IOr(mid): mid |= {'v': 'middle'}
+    mutations = [
+        ('', 'outer', 'middle', lambda mid: mid.__setitem__('v', 'middle')),
+        ('', 'outer', 'middle', lambda mid: mid.update({'v': 'middle'})),
+        ('', 'outer', 'middle', lambda mid: mid.setdefault('v', 'middle')),
+        ('', 'outer', 'middle', IOr),
+        ('v: middle', 'middle', 'outer', lambda mid: mid.__delitem__('v')),
+        ('v: middle', 'middle', 'outer', lambda mid: mid.pop('v')),
+        ('v: middle', 'middle', 'outer', lambda mid: mid.popitem()),
+        ('v: middle', 'middle', 'outer', lambda mid: mid.clear()),
+    ]
+    for i, (mid_v, before, after, mutate) in enumerate(mutations):
+      with self.subTest(mutation=i):
+        y = Load(mid_v)
+        sub = y['t']['mid']['sub']
+        self.assertEqual(sub['a'], before)
+        mutate(y['t']['mid'])
+        self.assertEqual(sub['b'], after)
+
   def test_array_comprehension(self):
     YAMLET = '''# Yamlet
     my_array: [1, 2, 'red', 'blue']
@@ -818,6 +1017,45 @@ class TestConditionals(unittest.TestCase):
     self.assertEqual(y['t'].keys(), {'a', 'b'})
     self.assertFalse('crap' in y['t'])
 
+  def test_constant_and_formatted_conditions_in_templates(self):
+    YAMLET = '''# Yamlet
+    t1:
+      !if (1 + 1 == 2):
+        a: 'two'
+      !if ('{kind}' == 'A'):
+        b: 'is A'
+      !else:
+        b: 'not A'
+    t2: !expr |
+        t1 { kind: 'A' }
+    t3: !expr |
+        t1 { kind: 'B' }
+    '''
+    loader = yamlet.Loader(self.Opts())
+    y = loader.load(YAMLET)
+    self.assertEqual(y['t2']['a'], 'two')
+    self.assertEqual(y['t3']['a'], 'two')
+    self.assertEqual(y['t2']['b'], 'is A')
+    self.assertEqual(y['t3']['b'], 'not A')
+
+  def test_ladder_keys_keep_declaration_order(self):
+    YAMLET = '''# Yamlet
+    t:
+      first: 1
+      !if kind == 'A':
+        zeta: 'z'
+        alpha: 'a'
+      !elif kind == 'B':
+        mu: 'm'
+        zeta: 'Z'
+      !else:
+        beta: 'b'
+      kind: 'B'
+    '''
+    loader = yamlet.Loader(self.Opts())
+    y = loader.load(YAMLET)
+    self.assertEqual(list(y['t'].keys()), ['first', 'zeta', 'mu', 'kind'])
+
   def test_nested_if_statements(self):
     # Another test from GPT, but this one, I asked for specifically. 😁
     YAMLET = '''# Yamlet
@@ -972,6 +1210,26 @@ class TestConditionals(unittest.TestCase):
     self.assertEqual(y['food'], 'pellet')
     self.assertEqual(y.keys(), {'food'})
 
+  def test_inherited_ladder_tuple_is_stable(self):
+    YAMLET = '''# Yamlet
+    t1:
+      k: A
+      !if k == 'A':
+        sub:
+          x: !expr k
+    t2: !composite
+      - t1
+      - {extra: 1}
+    '''
+    loader = yamlet.Loader(self.Opts())
+    y = loader.load(YAMLET)
+    t2 = y['t2']
+    sub = t2['sub']
+    self.assertIs(t2['sub'], sub)
+    sub['x'] = 'B'
+    self.assertEqual(t2['sub']['x'], 'B')
+    self.assertEqual(y['t1']['sub']['x'], 'A')
+
 
 @ParameterizedForStress
 class TestStress(unittest.TestCase):
@@ -1043,29 +1301,26 @@ class AssertRaisesCleanException:
       # Let other exceptions pass through
       return False
 
-    format_exc = traceback.format_exception(exc_type, exc_value, exc_traceback)
-    cut_from = 0
-    for i, line in enumerate(format_exc):
-      if ("The above exception was the direct cause of the following exception:"
-          in line or
-          "During handling of the above exception, another exception occurred:"
-          in line): cut_from = i + 1
-    ex = ''.join(format_exc[cut_from:])
-    tb = traceback.format_tb(exc_traceback)
+    # Only the outermost exception matters; its causes are not formatted.
+    ex = ''.join(traceback.format_exception(
+        exc_type, exc_value, exc_traceback, chain=False))
+    tb_len, tb = 0, exc_traceback
+    while tb:
+      tb_len, tb = tb_len + 1, tb.tb_next
 
     exlines = ex.splitlines()
-    fex = '  > ' + '\n  > '.join('\n'.join(exlines).splitlines())
-    if len(tb) >= 3:
-      raise AssertionError(f'Stack trace is ugly:\n{fex}\n'
+    fex = lambda: '  > ' + '\n  > '.join(exlines)
+    if tb_len >= 3:
+      raise AssertionError(f'Stack trace is ugly:\n{fex()}\n'
                            f'The above exception should have had {3} '
-                           f'calls on the stack, but had {len(tb)}.') from None
+                           f'calls on the stack, but had {tb_len}.') from None
     if len(exlines) <= self.min_context:
-      raise AssertionError(f'Yamlet trace is too small:\n{fex}\n'
+      raise AssertionError(f'Yamlet trace is too small:\n{fex()}\n'
                            f'The above exception should have been at least '
                            f'{self.min_context} lines, but was {len(exlines)}.'
       ) from None
     if len(exlines) >= self.max_context:
-      raise AssertionError(f'Yamlet trace is too large:\n{fex}\n'
+      raise AssertionError(f'Yamlet trace is too large:\n{fex()}\n'
                            f'The above exception should have been at most '
                            f'{self.max_context} lines, but was {len(exlines)}.'
       ) from None
@@ -1115,6 +1370,20 @@ class TestFlatCompositing(unittest.TestCase):
     self.assertEqual(y['flashy']['variable'], 'specialized value')
     self.assertEqual(y['boring']['variable'], 'defaulted value')
 
+  def test_repeated_plain_values(self):
+    YAMLET = '''# Yamlet
+    a: first
+    a: second
+    b: 1
+    b: 0
+    c: !expr a
+    '''
+    loader = yamlet.Loader(self.Opts())
+    y = loader.load(YAMLET)
+    self.assertEqual(y['a'], 'second')
+    self.assertEqual(y['b'], 0)
+    self.assertEqual(y['c'], 'second')
+
   def test_specializing_conditions_2(self):
     YAMLET = '''# Yamlet
     tp:
@@ -1246,6 +1515,19 @@ class TestRecursion(unittest.TestCase):
       val = y['recursive']['a']
       self.fail(f'Did not throw an exception; got `{val}`')
 
+  def test_repeated_errors_share_exception_class(self):
+    YAMLET = '''# Yamlet
+    recursive:
+      a: !expr b
+      b: !expr a
+    '''
+    loader = yamlet.Loader(self.Opts())
+    y = loader.load(YAMLET)
+    with self.assertRaises(yamlet.exceptions(RecursionError)):
+      y['recursive']['a']
+    with self.assertRaises(yamlet.exceptions(RecursionError)):
+      y['recursive']['b']
+
   def test_if_directive_recursion(self):
     '''This is gonna break a lot of people's minds and spirits.'''
     YAMLET = '''# Yamlet
@@ -1384,6 +1666,15 @@ class CrossModuleMechanics(unittest.TestCase):
     self.assertEqual(y['ext1_tup']['ref_module_global'], 'msg1')
     self.assertEqual(y['ext2_tup']['ref_module_global'], 'msg2')
 
+  def test_failed_load_can_be_retried(self):
+    loader = yamlet.Loader(self.Opts())
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = pathlib.Path(tmpdir) / 'module.yaml'
+      with self.assertRaises(FileNotFoundError):
+        loader.LoadCachedFile(path)
+      path.write_text('key: value\n')
+      self.assertEqual(loader.LoadCachedFile(path)['key'], 'value')
+
 
 @ParameterizedOnOpts
 class GptsTestIdeas(unittest.TestCase):
@@ -21,14 +21,16 @@
 # SOFTWARE.
 
 import ast
+import functools
 import io
+import itertools
 import keyword
+import operator
 import pathlib
 import re
 import ruamel.yaml
 import sys
 import token
-import tokenize
 import typing
 
 VERSION = '0.1.1'
@@ -45,7 +47,7 @@ class YamletOptions:
                missing_name_value=Error, warn_on_missing=True,
                functions=None, globals=None, module_vars=None,
                constructors=None, caching=CACHE_VALUES, exception_prefix=None,
-               _yamlet_debug_opts=None):
+               libyaml=False, _yamlet_debug_opts=None):
     self.import_resolver = import_resolver or str
     self.missing_name_value = missing_name_value
     self.warn_on_missing = warn_on_missing
@@ -55,6 +57,9 @@ class YamletOptions:
     self.constructors = constructors or {}
     self.caching = caching
     self.exception_prefix = exception_prefix
+    # Parse with libyaml (via ruamel.yaml.clib) when available. Much faster to
+    # load, but its marks carry no source snippets for error traces.
+    self.libyaml = libyaml
     self.debugging = _yamlet_debug_opts or _DebugOpts()
 
 
@@ -83,55 +88,97 @@ class ImportInfo:
     self.path, self.module_vars = path, module_vars
 
 
+# Constructors for Yamlet's built-in tags. These are shared by every Loader.
+def _ConstructUndefined(loader, node):
+  raise ConstructorError(
+      None, None,  f'No constructor bound for tag `{node.tag}`',
+      node.start_mark)
+
+
+def _ConstructFormat(loader, node):
+  fmt = loader.construct_scalar(node)
+  if '{' not in fmt and '}' not in fmt: return fmt  # Nothing to substitute.
+  return StringToSubstitute(fmt, YamlPoint(node.start_mark, node.end_mark))
+
+
+def _CheckMappingKeys(node):
+  # Brace-free `!fmt` scalars load as plain strings, which would otherwise pass
+  # as constant keys; reject them as key validation does for other `!fmt`s.
+  for key, _ in node.value:
+    if key.tag == '!fmt': raise ConstructorError(None, None,
+        'Yamlet keys from YAML mappings must be constant', key.start_mark)
+
+
+@functools.lru_cache(maxsize=None)
+def _ScalarConstructor(tp):
+  def Constructor(loader, node):
+    return tp(loader.construct_scalar(node),
+              YamlPoint(node.start_mark, node.end_mark))
+  return Constructor
+
+
+@functools.lru_cache(maxsize=None)
+def _ConstantConstructor(tag, val):
+  def Constructor(loader, node):
+    n = loader.construct_scalar(node)
+    if n != '': raise ConstructorError(None, None,
+        f'Yamlet `!{tag}` got unexpected node type: {repr(node)}',
+        node.start_mark)
+    return val
+  return Constructor
+
+
+@functools.lru_cache(maxsize=None)
+def _YamletConstructorBase(base):
+  '''Subclasses `base` with the built-in tags that don't depend on a Loader.
+
+  Built once per ruamel constructor class; each Loader subclasses the result
+  again for the tags bound to the loader itself and for user constructors.
+  '''
+  yc = type('YamletConstructorBase', (base,), {})
+  yc.add_constructor(None, _ConstructUndefined)  # Raise on undefined tags
+  yc.add_constructor("!fmt",       _ConstructFormat)
+  yc.add_constructor("!expr",      _ScalarConstructor(ExpressionToEvaluate))
+  yc.add_constructor("!lambda",    _ScalarConstructor(GclLambda))
+  yc.add_constructor("!local",     _ScalarConstructor(GclLocalKey))
+  yc.add_constructor("!if",        _ScalarConstructor(YamletIfStatement))
+  yc.add_constructor("!elif",      _ScalarConstructor(YamletElifStatement))
+  yc.add_constructor("!else",      Loader._ConstructElse)
+  yc.add_constructor("!null",      _ConstantConstructor('null',     null))
+  yc.add_constructor("!external",  _ConstantConstructor('external', external))
+  return yc
+
+
+@functools.lru_cache(maxsize=None)
+def _YamletRepresenterBase(base):
+  yr = type('YamletRepresenterBase', (base,), {})
+  yr.add_representer(GclDict, yr.represent_dict)
+  return yr
+
+
 class Loader(ruamel.yaml.YAML):
   def __init__(self, opts=None):
-    super().__init__()
     opts = opts or YamletOptions()
+    # Yamlet has no use for round-trip comment handling, so use the (much
+    # faster) safe pipeline. Keep its pure-Python parser unless asked, though:
+    # marks from the libyaml parser carry no source snippets for traces.
+    super().__init__(typ='safe', pure=not opts.libyaml)
+    # Ruamel registers constructors on the class; subclass per loader so that
+    # Yamlet's tags don't leak into other users of the safe constructor. The
+    # loader-independent tags are registered once, on a shared base class.
+    self.Constructor = type('YamletConstructor',
+                            (_YamletConstructorBase(self.Constructor),), {})
+    self.Representer = type('YamletRepresenter',
+                            (_YamletRepresenterBase(self.Representer),), {})
     self.yamlet_options = opts
     self.loaded_modules = {}
-    # Set custom dict type for base operations
-    self.constructor.yaml_base_dict_type = GclDict
-    self.representer.add_representer(GclDict, self.representer.represent_dict)
-
-    def UndefinedConstructor(self, node):
-      raise ConstructorError(
-          None, None,  f'No constructor bound for tag `{node.tag}`',
-          node.start_mark)
-    def GclImport(loader, node):
-      filename = loader.construct_scalar(node)
-      res = ModuleToLoad(filename, YamlPoint(node.start_mark, node.end_mark))
-      res._gcl_loader_ = lambda fn: self.LoadCachedFile(fn)
-      return res
-    def ConstructScalar(tp):
-      def Constructor(loader, node):
-        return tp(loader.construct_scalar(node),
-                  YamlPoint(node.start_mark, node.end_mark))
-      return Constructor
-    def ConstructConstant(tag, val):
-      def Constructor(loader, node):
-        n = loader.construct_scalar(node)
-        if n != '': raise ConstructorError(None, None,
-            f'Yamlet `!{tag}` got unexpected node type: {repr(node)}',
-            node.start_mark)
-        return val
-      return Constructor
 
     yc = self.constructor
-    yc.add_constructor(None, UndefinedConstructor)  # Raise on undefined tags
     yc.add_constructor(ruamel.yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
                        self.ConstructGclDict)
-    yc.add_constructor("!import",    GclImport)
+    yc.add_constructor("!import",    self.ConstructGclImport)
     yc.add_constructor("!composite", self.DeferGclComposite)
-    yc.add_constructor("!fmt",       ConstructScalar(StringToSubstitute))
-    yc.add_constructor("!expr",      ConstructScalar(ExpressionToEvaluate))
-    yc.add_constructor("!lambda",    ConstructScalar(GclLambda))
-    yc.add_constructor("!local",     ConstructScalar(GclLocalKey))
     yc.add_constructor("!template",  self.ConstructGclTemplate)
-    yc.add_constructor("!if",        ConstructScalar(YamletIfStatement))
-    yc.add_constructor("!elif",      ConstructScalar(YamletElifStatement))
-    yc.add_constructor("!else",      Loader._ConstructElse)
-    yc.add_constructor("!null",      ConstructConstant('null',     null))
-    yc.add_constructor("!external",  ConstructConstant('external', external))
     for tag, ctor in self.yamlet_options.constructors.items():
       if callable(ctor): self.add_constructor(tag, ctor)
       else:
@@ -177,7 +224,9 @@ class Loader(ruamel.yaml.YAML):
     return self
 
   def LoadCachedFile(self, fn):
-    fn = fn.resolve()
+    # Modules are keyed by resolved path. Imports pass paths already resolved,
+    # so try the path as given before touching the filesystem to resolve it.
+    if fn not in self.loaded_modules: fn = fn.resolve()
     if fn in self.loaded_modules:
       res = self.loaded_modules[fn]
       if res is None:
@@ -185,16 +234,23 @@ class Loader(ruamel.yaml.YAML):
                              'This isn\'t supposed to happen, as import loads '
                              'are deferred until name lookup.')
       return res
-    self.loaded_modules[fn] = None
-    with open(fn) as file:
-      try: res = self._ProcessYamlGcl(file)
-      except Exception as e:
-        self.loaded_modules.pop(fn)
-        raise
+    self.loaded_modules[fn] = None  # Recursion sentinel.
+    try:
+      with open(fn) as file: res = self._ProcessYamlGcl(file)
+    except BaseException:
+      self.loaded_modules.pop(fn, None)
+      raise
     self.loaded_modules[fn] = res
     return res
 
+  def ConstructGclImport(self, loader, node):
+    filename = loader.construct_scalar(node)
+    res = ModuleToLoad(filename, YamlPoint(node.start_mark, node.end_mark))
+    res._gcl_loader_ = self.LoadCachedFile
+    return res
+
   def ConstructGclDict(self, loader, node):
+    _CheckMappingKeys(node)
     try:
       return ProcessYamlPairs(
           loader.construct_pairs(node), gcl_opts=self.yamlet_options,
@@ -207,6 +263,7 @@ class Loader(ruamel.yaml.YAML):
           node.start_mark) from e
 
   def ConstructGclTemplate(self, loader, node):
+    _CheckMappingKeys(node)
     try:
       return ProcessYamlPairs(
           loader.construct_pairs(node), gcl_opts=self.yamlet_options,
@@ -223,7 +280,8 @@ class Loader(ruamel.yaml.YAML):
     if isinstance(node, ruamel.yaml.ScalarNode):
       return TupleListToComposite(loader.construct_scalar(node).split(), marks)
     if isinstance(node, ruamel.yaml.SequenceNode):
-      return TupleListToComposite(loader.construct_sequence(node), marks)
+      return TupleListToComposite(loader.construct_sequence(node, deep=True),
+                                  marks)
     raise ConstructorError(None, None,
         f'Yamlet `!composite` got unexpected node type: {repr(node)}',
         node.start_mark)
@@ -243,7 +301,7 @@ class Loader(ruamel.yaml.YAML):
   def _ProcessYamlGcl(self, ygcl):
     tup = super().load(_WrapStream(ygcl))
     ectx = None
-    while isinstance(tup, DeferredValue):
+    while type(tup) in _DEFERRED_TYPES:
       if not ectx:
         ectx = _EvalContext(None, self.yamlet_options, tup._yaml_point_,
                             'Evaluating preprocessors in Yamlet document.')
@@ -311,6 +369,7 @@ class Cloneable:
   All object references within a clone (such as parent pointers) should also be
   updated to point within the new cloned ecosystem.
   '''
+  __slots__ = ()
   def yamlet_clone(self, new_scope, ectx):
     raise NotImplementedError(
         'A class which extends `yamlet.Cloneable` should implement '
@@ -323,6 +382,7 @@ class Compositable(Cloneable):
   They must also be cloneable, so that merging them does not destroy the
   original template.
   '''
+  __slots__ = ()
   def yamlet_merge(self, other, ectx):
     ectx.Raise(NotImplementedError, 'A class which implements '
                '`yamlet.Compositable` should implement `yamlet_merge()`; '
@@ -356,11 +416,13 @@ class GclDict(dict, Compositable):
 
   def _resolvekv(self, k, v, ectx=None):
     bt_msg = f'Lookup of `{k}` in this scope'
+    # Lookups from expressions are recorded even for plain values, to explain
+    # the expression's result. Direct accesses have nothing to record.
     if ectx: ectx = ectx.BranchForNameResolution(bt_msg, k, self)
-    while isinstance(v, DeferredValue):
-      uncaught_recursion = None
-      ectx = ectx or (
-          _EvalContext(self, self._gcl_opts_, self._yaml_point_, name=bt_msg))
+    elif type(v) not in _DEFERRED_TYPES: return v
+    else: ectx = _EvalContext(self, self._gcl_opts_, self._yaml_point_,
+                              name=bt_msg)
+    while type(v) in _DEFERRED_TYPES:
       v = v._gcl_resolve_(ectx)
       # XXX: This is a nice optimization but breaks accessing templates before
       # their derived types. We need to let the caching done in DeferredValue
@@ -370,7 +432,7 @@ class GclDict(dict, Compositable):
 
   def __getitem__(self, key):
     try:
-      return self._resolvekv(key, super().__getitem__(key))
+      return self._resolvekv(key, dict.__getitem__(self, key))
     except ExceptionWithYamletTrace as e: exception_during_access = e
     e = exception_during_access
     exception_during_access = e.rewind()
@@ -380,17 +442,17 @@ class GclDict(dict, Compositable):
       raise exception_during_access
 
   def __contains__(self, key):
-    return super().get(key, null) is not null
+    return dict.get(self, key, null) is not null
 
   def items(self):
-    return ((k, self._resolvekv(k, v)) for k, v in super().items())
+    return ((k, self._resolvekv(k, v)) for k, v in dict.items(self))
 
   def values(self):
-    return (v for _, v in self.items())
+    return (self._resolvekv(k, v) for k, v in dict.items(self))
 
   def explain_value(self, k):
-    if k not in super().keys(): return f'`{k}` is not defined in this object.'
-    obj = super().__getitem__(k)
+    if k not in self: return f'`{k}` is not defined in this object.'
+    obj = dict.__getitem__(self, k)
     if isinstance(obj, DeferredValue):
       if not obj._gcl_provenance_:
         return f'`{k}` has not been evaluated; defined {_TuplePointStr(obj)}'
@@ -406,10 +468,25 @@ class GclDict(dict, Compositable):
     ectx.Assert(isinstance(other, GclDict) or
                 isinstance(other, PreprocessingTuple),
                 'Expected dict-like type to composite.', ex_class=TypeError)
-    for k, v in other._gcl_noresolve_items_():
+    # A leading run of plain values (often the whole tuple, for flat overrides)
+    # merges with one bulk update; the rest are handled individually below.
+    items = iter(other._gcl_noresolve_items_())
+    plain = {}
+    for k, v in items:
+      if (isinstance(v, Cloneable) or k in self._gcl_locals_
+          or v is null or v is external or v is _undefined):
+        items = itertools.chain(((k, v),), items)
+        break
+      plain[k] = v
+    if plain:
+      dict.update(self, plain)
+      provenances = other._gcl_provenances_
+      self._gcl_provenances_.update(
+          {k: provenances.get(k, other) for k in plain})
+    for k, v in items:
       if isinstance(v, Compositable):
         v1 = self._gcl_locals_.get(k, _undefined)
-        if v1 is _undefined: v1 = super().setdefault(k, _undefined)
+        if v1 is _undefined: v1 = dict.get(self, k, _undefined)
         if v1 is not _undefined:
           if not isinstance(v1, Compositable):
             ectx.Raise(TypeError, f'Cannot composite `{type(v1)}` object `{k}` '
@@ -424,12 +501,12 @@ class GclDict(dict, Compositable):
         self._gcl_kv_assign_(k, v.yamlet_clone(self, ectx))
       # NOTE: These other values will not have provenance info attached from a
       # merge or clone operation, as the assignments above do.
-      elif v or (v not in (null, external, _undefined)):
+      elif v is not null and v is not external and v is not _undefined:
         self._gcl_provenances_[k] = other._gcl_provenances_.get(k, other)
         self._gcl_kv_assign_(k, v)
       elif v is null:
         self._gcl_provenances_[k] = other._gcl_provenances_.get(k, other)
-        super().pop(k, None)
+        dict.pop(self, k, None)
       elif v is _undefined:
         ectx.Raise(AssertionError,
                    'An undefined value was propagated into a Yamlet tuple.')
@@ -441,28 +518,29 @@ class GclDict(dict, Compositable):
 
   def _gcl_kv_assign_(self, k, v):
     if k in self._gcl_locals_: self._gcl_locals_[k] = v
-    else: super().__setitem__(k, v)
+    else: dict.__setitem__(self, k, v)
 
   def _gcl_preprocess_(self, ectx):
     ectx = ectx.Branch('Yamlet Preprocessing', ectx._trace_point, self,
                        constrain_scope=True)
     for _, v in self._gcl_preprocessors_.items():
       v._gcl_preprocess_(ectx)
-    erased = set()
-    for k, v in self._gcl_noresolve_items_():
-      if isinstance(v, DeferredValue) and v._gcl_is_undefined_(ectx):
-        erased.add(k)
-    for k in erased: super().pop(k)
+    erased = [k for k, v in dict.items(self)
+              if type(v) in _DEFERRED_TYPES and v._gcl_is_undefined_(ectx)]
+    for k in erased: dict.pop(self, k)
 
-  def yamlet_clone(self, new_scope, ectx):
+  def yamlet_clone(self, new_scope, ectx, shadowed=None):
     cloned_preprocessors = {k: v.yamlet_clone(new_scope, ectx)
                             for k, v in self._gcl_preprocessors_.items()}
     res = GclDict(gcl_parent=new_scope, gcl_super=self, gcl_locals={},
                   gcl_opts=self._gcl_opts_, preprocessors=cloned_preprocessors,
                   gcl_is_template=False, yaml_point=ectx.GetPoint())
-    for k, v in self._gcl_noresolve_items_():
-      if isinstance(v, Cloneable): v = v.yamlet_clone(res, ectx)
-      res.__setitem__(k, v)
+    dict.update(res, self)  # Plain values are shared; rebind the rest below.
+    for k, v in dict.items(self):
+      if shadowed and k in shadowed and k not in self._gcl_locals_:
+        dict.__setitem__(res, k, shadowed[k])
+      elif isinstance(v, Cloneable):
+        dict.__setitem__(res, k, v.yamlet_clone(res, ectx))
     for k, v in self._gcl_locals_.items():
       if isinstance(v, Cloneable): v = v.yamlet_clone(res, ectx)
       res._gcl_locals_[k] = v
@@ -473,20 +551,22 @@ class GclDict(dict, Compositable):
         ectx.Branch('Fully evaluating nested tuple', self._yaml_point_, self)
         if ectx else _EvalContext(self, self._gcl_opts_, self._yaml_point_,
                                   name='Fully evaluating Yamlet tuple'))
-    def ev(v):
-      while isinstance(v, DeferredValue): v = v._gcl_resolve_(ectx)
+    res = {}
+    for k, v in dict.items(self):
+      if isinstance(v, (GclDict, PreprocessingTuple)) and v._gcl_is_template_:
+        continue
+      while type(v) in _DEFERRED_TYPES: v = v._gcl_resolve_(ectx)
       if isinstance(v, GclDict): v = v.evaluate_fully(ectx)
-      return v
-    def excl(k, v):
-      return isinstance(v, (GclDict, PreprocessingTuple)) and v._gcl_is_template_
-    return {k: ev(v) for k, v in self._gcl_noresolve_items_() if not excl(k, v)}
+      res[k] = v
+    return res
 
   def _gcl_update_parent_(self, parent): self._gcl_parent_ = parent
-  def _gcl_noresolve_values_(self): return super().values()
-  def _gcl_noresolve_items_(self): return super().items()
-  def _gcl_noresolve_get_(self, k): return super().__getitem__(k)
+  # Raw access bypassing resolution; bound straight to dict's C methods.
+  _gcl_noresolve_values_ = dict.values
+  _gcl_noresolve_items_ = dict.items
+  _gcl_noresolve_get_ = dict.__getitem__
   def _gcl_traceable_get_(self, key, ectx):
-    return self._resolvekv(key, super().__getitem__(key), ectx)
+    return self._resolvekv(key, dict.__getitem__(self, key), ectx)
 
 
 '''▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒░
@@ -500,8 +580,11 @@ class GclDict(dict, Compositable):
   ░▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒'''
 
 
+@functools.lru_cache(maxsize=None)
 def exceptions(bc):
-  '''Looks like a namespace in stack traces but is really a function.'''
+  '''Looks like a namespace in stack traces but is really a function.
+
+  Returns the same class for the same base, so these can also be caught.'''
   class YamletException(bc, YamletBaseException):
     def __init__(self, message, details):
       super().__init__(message)
@@ -521,6 +604,7 @@ class ExceptionWithYamletTrace(YamletBaseException):
 
 
 class YamlPoint:
+  __slots__ = ('start', 'end')
   def __init__(self, start, end):
     self.start = start
     self.end = end
@@ -541,6 +625,8 @@ class YamlPoint:
 
 
 class _EvalContext:
+  __slots__ = ('scope', 'opts', '_trace_point', '_evaluating', '_parent',
+               '_children', '_name_deps', '_constrain_scope')
   def __init__(self, scope, opts, yaml_point, name, parent=None, deferred=None,
                constrain_scope=False):
     self.scope = scope
@@ -557,15 +643,17 @@ class _EvalContext:
     return str(tace_item.start)
 
   class _ScopeVisit:
+    __slots__ = ('ectx', 'scope', 'oscope')
     def __init__(self, ectx, scope):
       self.ectx, self.scope, self.oscope = ectx, scope, ectx.scope
     def __enter__(self): self.ectx.scope = self.scope
     def __exit__(self, exc_type, exc_val, exc_tb): self.ectx.scope = self.oscope
 
   class _TracePoint(YamlPoint):
+    __slots__ = ('name',)
     def __init__(self, yaml_point, name):
-      super().__init__(yaml_point.start, yaml_point.end)
-      self.name = name
+      # Assigned directly; one is built for every evaluation context.
+      self.start, self.end, self.name = yaml_point.start, yaml_point.end, name
 
   def FormatError(yaml_point, msg): return f'{yaml_point.start}\n{msg}'
   def GetPoint(self): return self._trace_point
@@ -593,8 +681,7 @@ class _EvalContext:
                      parent=self))
 
   def BranchForDeferredEval(self, deferred_object, description):
-    tp = _EvalContext._TracePoint(deferred_object._yaml_point_, description)
-    if id(deferred_object) in self._EnumEvaluating():
+    if self._IsEvaluating(id(deferred_object)):
       self.Raise(RecursionError, 'Dependency cycle in tuple values.')
     return self._TrackChild(
         _EvalContext(self.scope, self.opts, deferred_object._yaml_point_,
@@ -656,14 +743,15 @@ class _EvalContext:
       message_sentence = f'{self.opts.exception_prefix}{message_sentence}'
     raise ExceptionWithYamletTrace(ex_class,
         f'{ex_class.__name__} occurred while evaluating a Yamlet expression:\n'
-        + '\n'.join(_EvalContext._PrettyError(t) for t in self.FullTrace())
+        + '\n'.join([_EvalContext._PrettyError(t) for t in self.FullTrace()])
         + f'\n{message_sentence}See above trace for more details.') from e
 
-  def _EnumEvaluating(self):
+  def _IsEvaluating(self, deferred_id):
     p = self
     while p:
-      if p._evaluating: yield p._evaluating
+      if p._evaluating == deferred_id: return True
       p = p._parent
+    return False
 
   def FullTrace(self):
     p = self
@@ -671,7 +759,7 @@ class _EvalContext:
     while p:
       trace.append(p._trace_point)
       p = p._parent
-    return trace[::-1]
+    return reversed(trace)
 
 
 '''▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒░
@@ -686,33 +774,43 @@ class _EvalContext:
 
 
 class DeferredValue(Cloneable):
+  __slots__ = ('_gcl_construct_', '_gcl_cache_', '_gcl_cached_',
+               '_gcl_cache_debug_', '_yaml_point_', '_gcl_provenance_')
   def __init__(self, data, yaml_point):
     self._gcl_construct_ = data
-    self._gcl_cache_ = _empty
+    self._gcl_cache_ = None
+    self._gcl_cached_ = False
+    self._gcl_cache_debug_ = _empty
     self._yaml_point_ = yaml_point
     self._gcl_provenance_ = None
 
+  def __init_subclass__(cls, **kwargs):
+    super().__init_subclass__(**kwargs)
+    _DEFERRED_TYPES.add(cls)
+
   def __eq__(self, other):
     return (isinstance(other, DeferredValue) and
             other._gcl_construct_ == self._gcl_construct_)
 
   def _gcl_update_parent_(self, parent): pass
   def _gcl_resolve_(self, ectx):
-    if self._gcl_cache_ is _empty:
-      self._gcl_provenance_ = ectx.BranchForDeferredEval(
-          self, self._gcl_explanation_())
-      res = self._gcl_evaluate_(self._gcl_construct_, self._gcl_provenance_)
-      if ectx.opts.caching == YamletOptions.CACHE_NOTHING: return res
-      if ectx.opts.caching == YamletOptions.CACHE_DEBUG:
-        if getattr(self, '_gcl_cache_debug_', _empty) is not _empty:
-          assert res == self._gcl_cache_debug_, ('Internal error: Cache bug! '
-              f'Cached value `{self._gcl_cache_debug_}` is not `{res}`!\n'
-              f'There is an error in how `{type(self).__name__}` '
-              f'values are being passed around.\nRepr: {self!r}')
-        self._gcl_cache_debug_ = res
-        return res
-      self._gcl_cache_ = res
-    return self._gcl_cache_
+    if self._gcl_cached_: return self._gcl_cache_
+    self._gcl_provenance_ = ectx.BranchForDeferredEval(
+        self, self._gcl_explanation_())
+    res = self._gcl_evaluate_(self._gcl_construct_, self._gcl_provenance_)
+    caching = ectx.opts.caching
+    if caching == YamletOptions.CACHE_NOTHING: return res
+    if caching == YamletOptions.CACHE_DEBUG:
+      if self._gcl_cache_debug_ is not _empty:
+        assert res == self._gcl_cache_debug_, ('Internal error: Cache bug! '
+            f'Cached value `{self._gcl_cache_debug_}` is not `{res}`!\n'
+            f'There is an error in how `{type(self).__name__}` '
+            f'values are being passed around.\nRepr: {self!r}')
+      self._gcl_cache_debug_ = res
+      return res
+    self._gcl_cache_ = res
+    self._gcl_cached_ = True
+    return res
 
   def yamlet_clone(self, new_scope, ectx):
     return type(self)(self._gcl_construct_, self._yaml_point_)
@@ -720,14 +818,25 @@ class DeferredValue(Cloneable):
   def _gcl_is_undefined_(self, ectx): return False
 
   def __str__(self):
-    return (f'<Unevaluated: {self._gcl_construct_}>' if not self._gcl_cache_
+    return (f'<Unevaluated: {self._gcl_construct_}>' if not self._gcl_cached_
             else str(self._gcl_cache_))
   def __repr__(self):
     return (f'{type(self).__name__}({self._gcl_construct_!r}, '
-            f'cache={self._gcl_cache_!r})')
+            f'cache={self._gcl_cache_ if self._gcl_cached_ else _empty!r})')
+
+
+# Value types that can be shared between tuples without risk of aliasing.
+_IMMUTABLE_TYPES = frozenset({
+    bool, int, float, complex, str, bytes, type(None)})
+
+
+# Every DeferredValue type, including user subclasses (via __init_subclass__).
+# Checking `type(v) in _DEFERRED_TYPES` is cheaper than `isinstance` in loops.
+_DEFERRED_TYPES = {DeferredValue}
 
 
 class ModuleToLoad(DeferredValue):
+  __slots__ = ('_gcl_loader_',)
   def __init__(self, *args, **kwargs): super().__init__(*args, **kwargs)
 
   def _gcl_explanation_(self):
@@ -755,6 +864,7 @@ class ModuleToLoad(DeferredValue):
 
 
 class StringToSubstitute(DeferredValue):
+  __slots__ = ()
   def __init__(self, *args, **kwargs): super().__init__(*args, **kwargs)
   def _gcl_explanation_(self):
     return f'Evaluating string `{self._gcl_construct_}`'
@@ -763,6 +873,7 @@ class StringToSubstitute(DeferredValue):
 
 
 class ExpressionToEvaluate(DeferredValue):
+  __slots__ = ()
   def __init__(self, *args, **kwargs): super().__init__(*args, **kwargs)
   def _gcl_explanation_(self):
     return f'Evaluating expression `{self._gcl_construct_.strip()}`'
@@ -771,9 +882,40 @@ class ExpressionToEvaluate(DeferredValue):
     except Exception as e:
       if isinstance(e, YamletBaseException): raise
       ectx.Raise(type(e), f'Error in Yamlet expression: {e}.\n', e)
+  def yamlet_clone(self, new_scope, ectx):
+    res = super().yamlet_clone(new_scope, ectx)
+    # An expression that can't depend on its scope has the same value in every
+    # clone; hand down an already-computed value if clones can't mutate it.
+    if (self._gcl_cached_ and type(self._gcl_cache_) in _IMMUTABLE_TYPES
+        and isinstance(self._gcl_construct_, str)
+        and _IsConstantExpr(self._gcl_construct_)):
+      res._gcl_cache_, res._gcl_cached_ = self._gcl_cache_, True
+      res._gcl_provenance_ = self._gcl_provenance_
+    return res
+
+
+class ParsedExpressionToEvaluate(ExpressionToEvaluate):
+  '''An expression taken from an already-parsed Yamlet expression, such as a
+  value in a tuple literal. Its AST is evaluated directly, without the round
+  trip through source text.'''
+  __slots__ = ()
+  def _gcl_explanation_(self):
+    return f'Evaluating expression `{ast.unparse(self._gcl_construct_)}`'
+  def __str__(self):
+    return (f'<Unevaluated: {ast.unparse(self._gcl_construct_)}>'
+            if not self._gcl_cached_ else str(self._gcl_cache_))
+  def __repr__(self):
+    return (f'{type(self).__name__}({ast.unparse(self._gcl_construct_)!r}, '
+            f'cache={self._gcl_cache_ if self._gcl_cached_ else _empty!r})')
+  def _gcl_evaluate_(self, value, ectx):
+    try: return EvalGclAst(value, ectx)
+    except Exception as e:
+      if isinstance(e, YamletBaseException): raise
+      ectx.Raise(type(e), f'Error in Yamlet expression: {e}.\n', e)
 
 
 class DeferredValueWrapper(DeferredValue):
+  __slots__ = ('klass',)
   def __init__(self, klass, *args, **kwargs):
     super().__init__(*args, **kwargs)
     self.klass = klass
@@ -781,11 +923,14 @@ class DeferredValueWrapper(DeferredValue):
     return self.klass(super()._gcl_evaluate_(value, ectx))
   def yamlet_clone(self, new_scope, ectx):
     return type(self)(self.klass, self._gcl_construct_, self._yaml_point_)
-class StringToSubAndWrap(DeferredValueWrapper, StringToSubstitute): pass
-class ExprToEvalAndWrap(DeferredValueWrapper, ExpressionToEvaluate): pass
+class StringToSubAndWrap(DeferredValueWrapper, StringToSubstitute):
+  __slots__ = ()
+class ExprToEvalAndWrap(DeferredValueWrapper, ExpressionToEvaluate):
+  __slots__ = ()
 
 
 class TupleListToComposite(DeferredValue):
+  __slots__ = ()
   def __init__(self, *args, **kwargs): super().__init__(*args, **kwargs)
   def _gcl_explanation_(self):
     return f'Compositing tuple list `{self._gcl_construct_}`'
@@ -796,8 +941,9 @@ class TupleListToComposite(DeferredValue):
 class IfLadderTableIndex(DeferredValue):
   '''Stashes a sequence of if expressions extracted from an if-else ladder,
   and evaluates them in order, caching the index of the first truthy expression.
-  Else is represented as -1; the final index in each IfLadderItem table.
+  Else is represented as -1, which is also its key in each IfLadderItem table.
   '''
+  __slots__ = ()
   def __init__(self, *args, **kwargs): super().__init__(*args, **kwargs)
   def _gcl_explanation_(self):
     return f'Pre-evaluating if-else ladder'
@@ -811,40 +957,54 @@ class IfLadderTableIndex(DeferredValue):
 class IfLadderItem(DeferredValue):
   '''References an extracted IfLadderTableIndex in its final scope to look up a
   value in a table, generated from its values in an if-else ladder.
+
+  Clones share the table with the item they were cloned from; only the entry
+  actually selected is cloned into the new scope, the first time it is chosen.
   '''
-  def __init__(self, *args, **kwargs):
+  __slots__ = ('_gcl_shared_', '_gcl_ladder_', '_gcl_clones_')
+  def __init__(self, *args, shared=False, **kwargs):
     super().__init__(*args, **kwargs)
+    self._gcl_shared_ = shared
+    self._gcl_ladder_ = (None, None)  # The last (scope, ladder) looked up.
+    self._gcl_clones_ = {}  # Table entries cloned into this scope, by index.
 
   def _gcl_explanation_(self):
     return f'Evaluating item in if-else ladder'
 
   def _gcl_evaluate_(self, value, ectx):
-    ladder, table = value
-    ladder = ectx.scope._gcl_preprocessors_.get(ladder)
-    ectx.Assert(ladder, 'Internal error: The preprocessor '
+    ladder_id, table = value
+    scope, ladder = self._gcl_ladder_
+    if scope is not ectx.scope:
+      ladder = ectx.scope._gcl_preprocessors_.get(ladder_id)
+      self._gcl_ladder_ = (ectx.scope, ladder)
+    if not ladder: ectx.Raise(AssertionError, 'Internal error: The preprocessor '
         f'`!if` directive from which this value was assigned was not inherited.'
-        f'\nGot: {(*ectx.scope._gcl_preprocessors_.keys(),)}\nWant: {ladder}')
+        f'\nGot: {(*ectx.scope._gcl_preprocessors_.keys(),)}\nWant: {ladder_id}')
     index = ladder.index._gcl_resolve_(ectx)
-    result = table[index]
-    while isinstance(result, DeferredValue): result = result._gcl_resolve_(ectx)
+    result = table.get(index, _undefined)
+    if self._gcl_shared_ and isinstance(result, Cloneable):
+      clone = self._gcl_clones_.get(index)
+      if clone is None:
+        clone = self._gcl_clones_[index] = result.yamlet_clone(ectx.scope, ectx)
+      result = clone
+    while type(result) in _DEFERRED_TYPES: result = result._gcl_resolve_(ectx)
     return result
 
   def yamlet_clone(self, new_scope, ectx):
-    return IfLadderItem((self._gcl_construct_[0], [
-        e.yamlet_clone(new_scope, ectx) if isinstance(e, Cloneable) else e
-        for i, e in enumerate(self._gcl_construct_[1])]), self._yaml_point_)
+    return IfLadderItem(self._gcl_construct_, self._yaml_point_, shared=True)
 
   def _gcl_update_parent_(self, parent):
-    _UpdateParents(self._gcl_construct_[1], parent)
+    if not self._gcl_shared_:
+      _UpdateParents(self._gcl_construct_[1].values(), parent)
 
   def _gcl_is_undefined_(self, ectx):
     try: result = self._gcl_resolve_(ectx)
     except Exception as e: return False  # Keep and let user discover the error.
-    if isinstance(result, DeferredValue): return result._gcl_is_undefined_(ectx)
-    return result is _undefined
+    return result is _undefined  # Evaluation already unwrapped deferred values.
 
 
 class FlatCompositor(DeferredValue):
+  __slots__ = ('_gcl_varname_',)
   def __init__(self, *args, varname, **kwargs):
     super().__init__(*args, **kwargs)
     self._gcl_varname_ = varname
@@ -852,15 +1012,18 @@ class FlatCompositor(DeferredValue):
     return f'Compositing values given for `{self._gcl_varname_}`'
 
   def _gcl_evaluate_(self, value, ectx):
+    # Plain values (e.g. a scalar key repeated in the YAML) just override.
+    if not any(isinstance(term, (DeferredValue, Compositable))
+               or term is external for term in value):
+      for term in reversed(value):
+        if term is not _undefined: return term
     active_composite = []
     for term in value:
-      while isinstance(term, DeferredValue): term = term._gcl_resolve_(ectx)
-      if term: active_composite.append(term)
-      else:
-        if term is _undefined: continue
-        if term is external: ectx.Raise(ValueError,
-            f'External value found while evaluating `{self._gcl_varname_}`.')
-        active_composite.append(term)
+      while type(term) in _DEFERRED_TYPES: term = term._gcl_resolve_(ectx)
+      if term is _undefined: continue
+      if term is external: ectx.Raise(ValueError,
+          f'External value found while evaluating `{self._gcl_varname_}`.')
+      active_composite.append(term)
     if len(active_composite) == 1: return active_composite[0]
     cxable = sum(isinstance(term, Compositable) for term in active_composite)
     if cxable != len(active_composite):
@@ -876,8 +1039,8 @@ class FlatCompositor(DeferredValue):
 
   def _gcl_is_undefined_(self, ectx):
     for term in self._gcl_construct_:
-      if not isinstance(term, DeferredValue): return False
-      if not term._gcl_is_undefined_(ectx): return False
+      if type(term) not in _DEFERRED_TYPES or not term._gcl_is_undefined_(ectx):
+        return False
     return True
 
   def add_compositing_value(self, value): self._gcl_construct_.append(value)
@@ -897,12 +1060,13 @@ class GclLambda:
   `EvalGclAst` checks for its type directly before raising that an object
   is not callable.
   '''
+  __slots__ = ('yaml_point', 'params', 'expression')
   def __init__(self, expr, yaml_point):
     self.yaml_point = yaml_point
     sep = expr.find(':')
     if sep < 0: raise ArgumentError(_EvalContext.FormatError(yaml_point,
         f'Lambda does not delimit arguments from expression: `{expr}`'))
-    self.params = [x.strip() for x in expr[:sep].split(',')]
+    self.params = tuple(x.strip() for x in expr[:sep].split(','))
     self.expression = expr[sep+1:]
 
   def Callable(self, name, ectx):
@@ -922,14 +1086,13 @@ class GclLambda:
       if kwargs: ectx.Raise(TypeError,
           f'Extra keyword arguments `{kwargs.keys()}` to lambda `{name}`')
       return _GclExprEval(self.expression, ectx.Branch(
-          f'lambda `{name}`', self.yaml_point, ectx.NewGclDict(
-              {params[i]: mapped_args[i] for i in range(len(params))}
-          )
-      ))
+          f'lambda `{name}`', self.yaml_point,
+          ectx.NewGclDict(dict(zip(params, mapped_args)))))
     return LambdaEvaluator
 
 
 class PreprocessingTuple(DeferredValue, Compositable):
+  __slots__ = ()
   def __init__(self, tup, yaml_point=None):
     assert(isinstance(tup, GclDict))
     super().__init__(tup, yaml_point or tup._yaml_point_)
@@ -940,27 +1103,28 @@ class PreprocessingTuple(DeferredValue, Compositable):
     return value
   def _gcl_update_parent_(self, parent):
     self._gcl_construct_._gcl_update_parent_(parent)
-  def keys(self): return self._gcl_construct_.keys()
-  def _gcl_noresolve_items_(self):
-    return self._gcl_construct_._gcl_noresolve_items_()
-  def __getattr__(self, attr):
-    if attr == '_gcl_parent_': return self._gcl_construct_._gcl_parent_
-    if attr == '_gcl_provenances_': return self._gcl_construct_._gcl_provenances_
-    if attr == '_gcl_preprocessors_':
-      return self._gcl_construct_._gcl_preprocessors_
-    if attr == '_gcl_is_template_': return self._gcl_construct_._gcl_is_template_
-    raise AttributeError(f'PreprocessingTuple has no attribute `{attr}`')
+  # The wrapped tuple is always a GclDict; read its storage directly.
+  def keys(self): return dict.keys(self._gcl_construct_)
+  def _gcl_noresolve_items_(self): return dict.items(self._gcl_construct_)
+  @property
+  def _gcl_parent_(self): return self._gcl_construct_._gcl_parent_
+  @property
+  def _gcl_provenances_(self): return self._gcl_construct_._gcl_provenances_
+  @property
+  def _gcl_preprocessors_(self): return self._gcl_construct_._gcl_preprocessors_
+  @property
+  def _gcl_is_template_(self): return self._gcl_construct_._gcl_is_template_
   def __eq__(self, other): return self._gcl_construct_ == other
-  def yamlet_clone(self, new_scope, ectx):
+  def yamlet_clone(self, new_scope, ectx, shadowed=None):
     return PreprocessingTuple(
-        self._gcl_construct_.yamlet_clone(new_scope, ectx))
+        self._gcl_construct_.yamlet_clone(new_scope, ectx, shadowed))
   def yamlet_merge(self, other, ectx):
     self._gcl_construct_.yamlet_merge(other, ectx)
 
 
 def _UpdateParents(items, parent):
   for i in items:
-    if isinstance(i, (GclDict, DeferredValue)):
+    if type(i) in _DEFERRED_TYPES or isinstance(i, GclDict):
       i._gcl_update_parent_(parent)
 
 
@@ -975,6 +1139,9 @@ def _UpdateParents(items, parent):
   ░▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒'''
 
 
+_ELSE_COLON_RE = re.compile('(\\s*!else):(\\s*#.*|\\s*)$', re.MULTILINE)
+
+
 def _FixElseColons(s):
   '''This is a miserable hack that is necessary to save headaches for now.
 
@@ -986,12 +1153,20 @@ def _FixElseColons(s):
   which could modify a value in user data if it appears inside a literal-style
   block. There's nothing reasonable I can do about that right now.
   '''
-  return re.sub('(\\s*!else):(\\s*#.*|\\s*)$', r'\1 :\2', s, flags=re.MULTILINE)
+  if '!else' not in s: return s
+  return _ELSE_COLON_RE.sub(r'\1 :\2', s)
 
 
 class ReplaceElseStream(io.IOBase):
   def __init__(self, original_stream):
     self.original_stream = original_stream
+    # Bind positioning methods directly; io.IOBase would otherwise shadow them
+    # with stubs, and direct attributes skip the __getattr__ fallback. Not
+    # close(), which IOBase calls when this wrapper is collected.
+    self.tell = original_stream.tell
+    self.seek = original_stream.seek
+    self.seekable = original_stream.seekable
+    self.readable = original_stream.readable
 
   def read(self, size=-1):
     data = self.original_stream.read(size)
@@ -1002,7 +1177,8 @@ class ReplaceElseStream(io.IOBase):
     return line and _FixElseColons(line)
 
   def readlines(self):
-    return [_FixElseColons(line) for line in self.original_stream.readlines()]
+    data = _FixElseColons(self.original_stream.read())
+    return io.StringIO(data, newline='\n').readlines()
 
   # Delegate other file-like operations to the original stream
   def __getattr__(self, attr):
@@ -1027,6 +1203,7 @@ def _WrapStream(s):
 
 
 class PreprocessingDirective():
+  __slots__ = ('_gcl_construct_', '_yaml_point_')
   def __init__(self, data, yaml_point):
     self._gcl_construct_ = data
     self._yaml_point_ = yaml_point
@@ -1039,70 +1216,74 @@ class PreprocessingDirective():
     )
 
 
-class GclLocalKey(PreprocessingDirective): pass
+class GclLocalKey(PreprocessingDirective): __slots__ = ()
 
 
-class YamletIfStatement(PreprocessingDirective): pass
-class YamletElifStatement(PreprocessingDirective): pass
-class YamletElseStatement(PreprocessingDirective): pass
+class YamletIfStatement(PreprocessingDirective): __slots__ = ()
+class YamletElifStatement(PreprocessingDirective): __slots__ = ()
+class YamletElseStatement(PreprocessingDirective): __slots__ = ()
 class YamletIfElseLadder(PreprocessingDirective):
-  def __init__(self, k=None, v=None, *, index=None, cond_dvals=None):
-    if index:
-      index._gcl_construct_ = self
-      self.index = index  # An `IfLadderTableIndex` to translate this ladder.
-      self.cond_dvals = cond_dvals
-      return
+  __slots__ = ('if_statement', 'else_statement', 'elif_statements', 'branches',
+               'cond_dvals', 'cond_consts', 'index')
+  def __init__(self, k, v):
     assert isinstance(k, YamletIfStatement)
     assert isinstance(v, (GclDict, PreprocessingTuple))
     self.if_statement = (k, v)  # k is the !if expression, v is the GclDict.
     self.else_statement = None  # Similarly, k is !else None, v is GclDict.
     self.elif_statements = []   # Sequence of k, v pairs for each !elif.
-    self.all_vars = set(v.keys())
 
   def PutElif(self, k, v):
     self.elif_statements.append((k, v))
-    self.all_vars |= v.keys()
 
   def PutElse(self, k, v):
     self.else_statement = (k, v)
-    self.all_vars |= v.keys()
 
   def Finalize(self, filtered_pairs, cErr):
-    size = 2 + len(self.elif_statements)
-    arrays = {k: [_undefined] * size for k in self.all_vars}
+    # Tables are keyed by branch index; branches not assigning a key are absent.
+    # Keys are tabled in order of first appearance in the ladder.
+    tables = {}
     ladder_point = self.if_statement[0]._yaml_point_
-    for k, v in self.if_statement[1]._gcl_noresolve_items_():
-      arrays[k][0] = v
-    for i, elif_statement in enumerate(self.elif_statements):
-      for k, v in elif_statement[1]._gcl_noresolve_items_():
-        arrays[k][i + 1] = v
-    if self.else_statement:
-      for k, v in self.else_statement[1]._gcl_noresolve_items_():
-        arrays[k][-1] = v
-    for k, v in arrays.items():
+    # (index, tuple) for each branch; also used to gather their preprocessors.
+    self.branches = branches = [(0, self.if_statement[1])]
+    branches += ((i, e[1]) for i, e in enumerate(self.elif_statements, 1))
+    if self.else_statement: branches.append((-1, self.else_statement[1]))
+    for i, branch in branches:
+      for k, v in branch._gcl_noresolve_items_():
+        table = tables.get(k)
+        if table is None: table = tables[k] = {}
+        table[i] = v
+    for k, v in tables.items():
       v0 = IfLadderItem((id(self), v), ladder_point)
       v1 = filtered_pairs.setdefault(k, v0)
       if v0 is not v1:
         filtered_pairs[k] = FlatCompositor([v1, v0], ladder_point, varname=k)
-    expr_points = [self.if_statement[0]] + [e[0] for e in self.elif_statements]
-    self.cond_dvals = [ExpressionToEvaluate(ep._gcl_construct_, ep._yaml_point_)
-                       for ep in expr_points]
+    # Conditions that can't vary by scope are shared by every clone of this
+    # ladder, so that they're only evaluated once.
+    self.cond_dvals, self.cond_consts = [], []
+    for ep in itertools.chain((self.if_statement[0],),
+                              (e[0] for e in self.elif_statements)):
+      self.cond_dvals.append(
+          ExpressionToEvaluate(ep._gcl_construct_, ep._yaml_point_))
+      self.cond_consts.append(_IsConstantExpr(ep._gcl_construct_))
     self.index = IfLadderTableIndex(self, ladder_point)
 
   def AddToPreprocessorsDict(self, preprocessors):
     preprocessors[id(self)] = self
-    preprocessors |= self.if_statement[1]._gcl_preprocessors_
-    for elif_statement in self.elif_statements:
-      preprocessors |= elif_statement[1]._gcl_preprocessors_
-    if self.else_statement:
-      preprocessors |= self.else_statement[1]._gcl_preprocessors_
+    for _, branch in self.branches:
+      if branch._gcl_preprocessors_:
+        preprocessors |= branch._gcl_preprocessors_
 
   def _gcl_preprocess_(self, ectx): pass
 
   def yamlet_clone(self, new_scope, ectx):
-    return YamletIfElseLadder(
-        index=self.index.yamlet_clone(new_scope, ectx),
-        cond_dvals=[dv.yamlet_clone(new_scope, ectx) for dv in self.cond_dvals])
+    # Clones only need what evaluation reads, not the parsed branches.
+    res = YamletIfElseLadder.__new__(YamletIfElseLadder)
+    res.index = self.index.yamlet_clone(new_scope, ectx)
+    res.index._gcl_construct_ = res  # Translates this ladder.
+    res.cond_dvals = [dv if const else dv.yamlet_clone(new_scope, ectx)
+                      for dv, const in zip(self.cond_dvals, self.cond_consts)]
+    res.cond_consts = self.cond_consts
+    return res
 
 
 def _FlatCompositingType(v):
@@ -1171,7 +1352,7 @@ def ProcessYamlPairs(mapping_pairs, gcl_opts, yaml_point, is_template):
       raise cErr('Yamlet keys from YAML mappings must be constant', k)
     else:
       terminateIfDirective()
-      if not isinstance(k, typing.Hashable):
+      if type(k) is not str and not isinstance(k, typing.Hashable):
         raise cErr(f'found unacceptable key (unhashable type: \''
                    f'{type(k).__name__}\'): {k}')
       v0 = filtered_pairs.setdefault(k, v)
@@ -1206,14 +1387,19 @@ def ProcessYamlPairs(mapping_pairs, gcl_opts, yaml_point, is_template):
   ░▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒▒'''
 
 
+_KEYWORDS = frozenset(keyword.kwlist)
+_COLLIDING_TOKENS = frozenset({token.NAME, token.NUMBER, token.STRING, token.OP})
+# Pairs of token types which may be juxtaposed operands; adjacent strings are
+# concatenated by Python, so they don't count.
+_COLLIDING_PAIRS = frozenset(
+    (t1, t2) for t1 in _COLLIDING_TOKENS for t2 in _COLLIDING_TOKENS
+    if not t1 == t2 == token.STRING)
+
+
 def _TokensCollide(t1, t2):
-  if not t1: return False
-  colliding_tokens = {token.NAME, token.NUMBER, token.STRING, token.OP}
-  if t1.type not in colliding_tokens or t2.type not in colliding_tokens:
-    return False
-  if t1.type == token.NAME and keyword.iskeyword(t1.string): return False
-  if t2.type == token.NAME and keyword.iskeyword(t2.string): return False
-  if t1.type == token.STRING and t2.type == token.STRING: return False
+  if not t1 or (t1.type, t2.type) not in _COLLIDING_PAIRS: return False
+  if t1.type == token.NAME and t1.string in _KEYWORDS: return False
+  if t2.type == token.NAME and t2.string in _KEYWORDS: return False
   if t1.type == token.NAME and t2.type == token.OP:  return t2.string == '{'
   if t2.type == token.OP and t2.string not in '({': return False
   if t1.type == token.OP and t1.string not in ')}': return False
@@ -1224,8 +1410,16 @@ def _TuplePointStr(tup):
   return str(tup._yaml_point_.start).lstrip()
 
 
+@functools.lru_cache(maxsize=4096)
 def _InsertCompositOperators(expr):
-  tokens = tokenize.tokenize(io.BytesIO(expr.encode('utf-8')).readline)
+  '''Parses a Yamlet expression into a Python AST, with `@` between operands
+  which are juxtaposed to composite them.
+
+  The result is cached per expression string, so it must not be mutated. The
+  cache is bounded, as it outlives the documents whose text it is keyed on.
+  '''
+  import tokenize  # Deferred; documents without expressions never need it.
+  tokens = tokenize.generate_tokens(io.StringIO(expr).readline)
   token_blocks = []
   cur_tokens = []
   fstring = 0
@@ -1240,12 +1434,16 @@ def _InsertCompositOperators(expr):
     cur_tokens.append(tok)
     if tok.type != token.COMMENT: prev_tok = tok
   token_blocks.append(cur_tokens)
-  def Untokenize(tokens):
-    untokenized = tokenize.untokenize(tokens)
-    if not isinstance(untokenized, str):
-      untokenized = untokenized.decode('utf-8')
-    return untokenized
-  untokenized = '\n@ '.join([Untokenize(tokens) for tokens in token_blocks])
+  if len(token_blocks) == 1: untokenized = expr  # Nothing to composite.
+  else:
+    # Slice each block out of the source rather than untokenizing it; a
+    # block runs up to where the next one's first token starts.
+    line_offsets = list(itertools.accumulate(
+        map(len, io.StringIO(expr).readlines()), initial=0))
+    cuts = [line_offsets[row - 1] + col for row, col in
+            (block[0].start for block in token_blocks[1:])]
+    untokenized = '\n@ '.join(
+        [expr[i:j] for i, j in zip([0] + cuts, cuts + [len(expr)])])
   expstr = f'(\n{untokenized}\n)'
   try: return ast.parse(expstr, mode='eval')
   except Exception as e:
@@ -1253,14 +1451,39 @@ def _InsertCompositOperators(expr):
                       f' when processing these chunks: {token_blocks}') from e
 
 
-def _ResolveStringValue(val, ectx):
-  res = ''
+@functools.lru_cache(maxsize=4096)
+def _IsConstantExpr(expr):
+  '''Returns whether an expression can't depend on the scope it's evaluated in:
+  it names no variables and contains no strings with `{}` substitutions.'''
+  try: tree = _InsertCompositOperators(expr)
+  except SyntaxError: return False  # Reported when actually evaluated.
+  for node in ast.walk(tree):
+    if isinstance(node, ast.Name): return False
+    if (isinstance(node, ast.Constant) and isinstance(node.value, str)
+        and ('{' in node.value or '}' in node.value)): return False
+  return True
+
+
+_BRACE_RE = re.compile('[{}]')
+
+
+@functools.lru_cache(maxsize=4096)
+def _ParseStringTemplate(val):
+  '''Splits a format string into alternating literals and expressions.
+
+  The result always begins and ends with a literal, so expressions sit at the
+  odd indices. Templates are cached by string, so resolving a cloned or
+  re-evaluated `!fmt` value usually only has to evaluate the expressions.
+  '''
+  pieces = []
+  lit = []  # Literal text since the last expression, joined when it ends.
   j, d = 0, 0
   dclose = False
-  for i, c in enumerate(val):
+  for m in _BRACE_RE.finditer(val):  # Only braces affect the scan.
+    i, c = m.start(), m.group()
     if c == '{':
       if d == 0:
-        res += val[j:i]
+        lit.append(val[j:i])
         j = i + 1
       d += 1
       if d == 2 and i == j:
@@ -1270,31 +1493,44 @@ def _ResolveStringValue(val, ectx):
       if d > 0:
         d -= 1
         if d == 0:
-          exp = val[j:i]
-          res += str(_GclExprEval(exp, ectx))
+          pieces += (''.join(lit), val[j:i])
+          lit = []
           j = i + 1
         dclose = False
       else:
         if dclose:
           dclose = False
-          res += val[j:i]
+          lit.append(val[j:i])
           j = i + 1
         else:
           dclose = True
+  lit.append(val[j:])
+  pieces.append(''.join(lit))
+  return tuple(pieces)
 
-  res += val[j:]
-  return res
+
+def _ResolveStringValue(val, ectx):
+  pieces = _ParseStringTemplate(val)
+  if len(pieces) == 1: return pieces[0]  # No expressions to substitute.
+  pieces = list(pieces)
+  for i in range(1, len(pieces), 2):
+    pieces[i] = str(_GclExprEval(pieces[i], ectx))
+  return ''.join(pieces)
 
 
 def _CompositeYamlTupleList(tuples, ectx):
-  ectx.Assert(isinstance(tuples, list),
-              f'Expected list of tuples to composite; got {type(tuples)}')
+  if not isinstance(tuples, list): ectx.Raise(AssertionError,
+      f'Expected list of tuples to composite; got {type(tuples)}')
   ectx.Assert(tuples, 'Attempting to composite empty list of tuples')
+  evaluated = {}  # Operands named more than once are only evaluated once.
   for i, t in enumerate(tuples):
-    if isinstance(t, DeferredValue): tuples[i] = t._gcl_resolve_(ectx)
-    elif isinstance(t, str): tuples[i] = _GclExprEval(t, ectx)
-    elif not isinstance(t, GclDict): raise TypeError(
-        f'{yaml_point}\nUnknown composite mechanism for {type(t)}')
+    if type(t) in _DEFERRED_TYPES: tuples[i] = t._gcl_resolve_(ectx)
+    elif isinstance(t, str):
+      r = evaluated.get(t, _empty)
+      if r is _empty: r = evaluated[t] = _GclExprEval(t, ectx)
+      tuples[i] = r
+    elif not isinstance(t, GclDict): ectx.Raise(
+        TypeError, f'Unknown composite mechanism for `{type(t).__name__}`.')
   return _CompositeGclTuples(tuples, ectx)
 
 
@@ -1315,23 +1551,24 @@ class ArgumentDeferringFunction:
     return self.func(ectx, *args, **kwargs)
 
 
-def _BuiltinFuncsMapper():
-  @ArgumentDeferringFunction
-  def cond(ectx, condition, if_true, if_false):
-    return (EvalGclAst(if_true, ectx) if EvalGclAst(condition, ectx)
-            else EvalGclAst(if_false, ectx))
-  # XXX: I elided next() because it's ugly and throws; probably better to add
-  # an nth() method that just returns the nth item in the sequence, or maybe
-  # just pile itertools onto the stack.
-  python_builtins = [
-      abs, all, any, ascii, bin, bool, bytearray, bytes, callable, chr, complex,
-      dict, divmod, enumerate, filter, float, format, frozenset, getattr,
-      hasattr, hash, hex, id, int, isinstance, issubclass, iter, len, list, map,
-      max, min, oct, ord, range, repr, reversed, round, set, setattr, slice,
-      sorted, str, sum, tuple, type, vars, zip
-  ]
-  return { 'cond': cond } | {bi.__name__: bi for bi in python_builtins}
-_BUILTIN_FUNCS = _BuiltinFuncsMapper()
+@ArgumentDeferringFunction
+def _BuiltinCond(ectx, condition, if_true, if_false):
+  return (EvalGclAst(if_true, ectx) if EvalGclAst(condition, ectx)
+          else EvalGclAst(if_false, ectx))
+
+
+# XXX: I elided next() because it's ugly and throws; probably better to add
+# an nth() method that just returns the nth item in the sequence, or maybe
+# just pile itertools onto the stack.
+_PYTHON_BUILTINS = [
+    abs, all, any, ascii, bin, bool, bytearray, bytes, callable, chr, complex,
+    dict, divmod, enumerate, filter, float, format, frozenset, getattr,
+    hasattr, hash, hex, id, int, isinstance, issubclass, iter, len, list, map,
+    max, min, oct, ord, range, repr, reversed, round, set, setattr, slice,
+    sorted, str, sum, tuple, type, vars, zip
+]
+_BUILTIN_FUNCS = {'cond': _BuiltinCond} | {
+    bi.__name__: bi for bi in _PYTHON_BUILTINS}
 
 
 _BUILTIN_NAMES = {
@@ -1343,35 +1580,70 @@ _BUILTIN_NAMES = {
 _BUILTIN_VARS = {
   'external': external, 'null': null
 }
+_BUILTIN_KEYS = frozenset(_BUILTIN_NAMES) | frozenset(_BUILTIN_VARS)
 
 
-def _GclNameLookup(name, ectx, top=True):
-  '''Main lookup and scope resolution mechanism.'''
-  if name in _BUILTIN_NAMES: return _BUILTIN_NAMES[name](ectx)
-  if name in _BUILTIN_VARS: return _BUILTIN_VARS[name]
-  if name in ectx.scope:
-    get = ectx.scope._gcl_traceable_get_(name, ectx)
+def _GclScopeLookup(name, ectx):
+  '''Searches the current tuple, then its parents and its supers' parents.
+
+  Returns the value found and the tuple which defined it, or `_undefined` and
+  `None` if no tuple in the chain defines the name.
+
+  The search is depth-first: a tuple's whole parent chain is searched before
+  its supers' parents. It is run with an explicit stack rather than recursion.
+  '''
+  origin = ectx.scope
+  path = []  # Iterators over the outer scopes of each tuple searched.
+  scope = origin
+  try:
+    while True:
+      ectx.scope = scope
+      res, owner = _GclScopeLookupHere(name, ectx, scope)
+      if owner is not None: return res, owner
+      path.append(_GclOuterScopes(scope))
+      scope = None
+      while path:
+        scope = next(path[-1], None)
+        if scope is not None: break
+        path.pop()
+      if scope is None: return _undefined, None
+  finally:
+    ectx.scope = origin
+
+
+def _GclScopeLookupHere(name, ectx, scope):
+  '''Checks one tuple's own values and locals.'''
+  if dict.get(scope, name, null) is not null:  # Inlined `name in scope`.
+    get = scope._gcl_traceable_get_(name, ectx)
     if get is external:
       ectx.Raise(ValueError, f'`{name}` is external in this scope')
-    if get is not null: return get
-  res = ectx.scope._gcl_locals_.get(name, _undefined)
+    if get is not null: return get, scope
+  res = scope._gcl_locals_.get(name, _undefined)
   if res is not _undefined and res is not null:
     if res is external:
       ectx.Raise(ValueError, f'`{name}` is external in this scope')
-    return res
-  if ectx.scope._gcl_parent_:
-    with ectx.Scope(ectx.scope._gcl_parent_):
-      res = _GclNameLookup(name, ectx, top=False)
-      if res is not _undefined: return res
-  sup = ectx.scope._gcl_super_
+    return res, scope
+  return _undefined, None
+
+
+def _GclOuterScopes(scope):
+  '''Yields the tuples to search after `scope`, in order.'''
+  # Compared to None, as an emptied parent tuple is falsy but still in scope.
+  if scope._gcl_parent_ is not None: yield scope._gcl_parent_
+  sup = scope._gcl_super_
   while sup is not None:
-    if sup._gcl_parent_:
-      with ectx.Scope(sup._gcl_parent_):
-        res = _GclNameLookup(name, ectx, top=False)
-        if res is not _undefined: return res
+    if sup._gcl_parent_ is not None: yield sup._gcl_parent_
     sup = sup._gcl_super_
-  if not top: return _undefined
-  # Only at the topmost scope: check module locals next.
+
+
+def _GclNameLookup(name, ectx):
+  '''Main lookup and scope resolution mechanism.'''
+  if name in _BUILTIN_KEYS:
+    if name in _BUILTIN_NAMES: return _BUILTIN_NAMES[name](ectx)
+    return _BUILTIN_VARS[name]
+  res, owner = _GclScopeLookup(name, ectx)
+  if owner is not None: return res
+  # Check module locals next.
   mvars = ectx.opts.module_vars.get(ectx.ModuleFilename())
   if mvars:
     res = mvars.get(name, _undefined)
@@ -1379,9 +1651,10 @@ def _GclNameLookup(name, ectx, top=True):
   # We've checked everything in the current context. Go up a context.
   upctx = ectx.UpScope()
   while upctx:
-    try: res = _GclNameLookup(name, upctx, top=False)
+    owner = None
+    try: res, owner = _GclScopeLookup(name, upctx)
     except Exception as e: print(e)
-    if res is not _undefined: return res
+    if owner is not None: return res
     upctx = upctx.UpScope()
   # All parse-wide globals from YamletOptions
   res = ectx.opts.globals.get(name, _undefined)
@@ -1395,7 +1668,14 @@ def _GclNameLookup(name, ectx, top=True):
 
 
 def _GclExprEval(expr, ectx):
-  return EvalGclAst(_InsertCompositOperators(expr), ectx)
+  if expr.isidentifier() and expr.isascii() and expr not in _KEYWORDS:
+    # A bare name, such as `{name}` in a format string; skip the parse cache.
+    # (Non-ASCII names go through the parser, which NFKC-normalizes them.)
+    res = _GclNameLookup(expr, ectx)
+    while type(res) in _DEFERRED_TYPES: res = res._gcl_resolve_(ectx)
+    return res
+  # Evaluate the body directly, skipping a dispatch on the `ast.Expression`.
+  return EvalGclAst(_InsertCompositOperators(expr).body, ectx)
 
 
 def _EvalComprehension(elt, generators, ectx, index=0):
@@ -1408,12 +1688,12 @@ def _EvalComprehension(elt, generators, ectx, index=0):
   generator = generators[index]
   iter_values = EvalGclAst(generator.iter, ectx)
 
-  ectx.Assert(isinstance(iter_values, typing.Iterable),
-              f'Expected an iterable in generator expression, '
-              f'got `{type(iter_values).__name__}`.', TypeError)
-  ectx.Assert(isinstance(generator.target, (ast.Name, ast.Tuple)),
-              f'Comprehension target should be Name or Tuple, '
-              f'but got `{type(generator.target).__name__}`', TypeError)
+  if not isinstance(iter_values, typing.Iterable): ectx.Raise(TypeError,
+      f'Expected an iterable in generator expression, '
+      f'got `{type(iter_values).__name__}`.')
+  if not isinstance(generator.target, (ast.Name, ast.Tuple)): ectx.Raise(
+      TypeError, f'Comprehension target should be Name or Tuple, '
+      f'but got `{type(generator.target).__name__}`')
 
   for item in iter_values:
     # Set up target variables in a new scope
@@ -1435,190 +1715,263 @@ def _EvalComprehension(elt, generators, ectx, index=0):
       yield from _EvalComprehension(elt, generators, scoped_ectx, index + 1)
 
 
-def EvalGclAst(et, ectx):
-  ev = lambda x: EvalGclAst(x, ectx)
-  match type(et):
-    case ast.Expression: return ev(et.body)
-    case ast.Name:
-      res = _GclNameLookup(et.id, ectx)
-      while isinstance(res, DeferredValue): res = res._gcl_resolve_(ectx)
-      return res
-    case ast.Constant:
-      if isinstance(et.value, str):
-        return _ResolveStringValue(et.value, ectx)
-      return et.value
-
-    case ast.JoinedStr:
-      return ''.join(ev(v) for v in et.values)
-
-    case ast.FormattedValue:
-      v = ev(et.value)
-      match et.conversion:
-        case -1:  v = f'{v}'  # XXX: documentation does not say what this is
-        case 115: v = str(v)
-        case 114: v = repr(v)
-        case 97:  v = ascii(v)
-        case _: ectx.Raise(f'Unsupported Python conversion {et.conversion}')
-      if not et.format_spec: return v
-      return ev(et.format_spec).format(v)
-
-    case ast.Attribute:
-      val = ev(et.value)
-      if et.attr in _BUILTIN_NAMES:
-        with ectx.Scope(val): return _BUILTIN_NAMES[et.attr](ectx)
-      if isinstance(val, GclDict):
-        try: return val._gcl_traceable_get_(et.attr, ectx)
-        except KeyError: ectx.Raise(KeyError, f'No {et.attr} in this scope.')
-      try:
-        if isinstance(val, GclDict): return val[et.attr]
-        else: return getattr(val, et.attr)
-      except Exception as e:
-        ectx.Raise(KeyError, f'Cannot access attribute on value:\n  value'
-             f'({type(val).__name__}): {val}\n  attribute: {et.attr}\n', e)
-    case ast.BinOp:
-      l, r = ev(et.left), ev(et.right)
-      match type(et.op):
-        case ast.Add:      return l + r
-        case ast.Sub:      return l - r
-        case ast.Mult:     return l * r
-        case ast.Div:      return l / r
-        case ast.Mod:      return l % r
-        case ast.BitAnd:   return l & r
-        case ast.BitOr:    return l | r
-        case ast.BitXor:   return l ^ r
-        case ast.FloorDiv: return l // r
-        case ast.LShift:   return l << r
-        case ast.RShift:   return l >> r
-        case ast.MatMult:  return _CompositeGclTuples([l, r], ectx)
-      ectx.Raise(NotImplementedError,
-                 f'Unsupported binary operator `{type(et.op).__name__}`.')
-    case ast.UnaryOp:
-      match type(et.op):
-        case ast.UAdd:   return +ev(et.operand)
-        case ast.USub:   return -ev(et.operand)
-        case ast.Not:    return not ev(et.operand)
-        case ast.Invert: return ~ev(et.operand)
-      ectx.Raise(NotImplementedError,
-                 f'Unsupported unary operator `{type(et.op).__name__}`.')
-
-
-    case ast.Compare:
-      l = ev(et.left)
-      for op, r in zip(et.ops, et.comparators):
-        r = ev(r)
-        match type(op):
-          case ast.Eq:     v = l == r
-          case ast.NotEq:  v = l != r
-          case ast.Lt:     v = l < r
-          case ast.LtE:    v = l <= r
-          case ast.Gt:     v = l > r
-          case ast.GtE:    v = l >= r
-          case ast.Is:     v = l is r
-          case ast.IsNot:  v = l is not r
-          case ast.In:     v = l in r
-          case ast.NotIn:  v = l not in r
-          case _: ectx.Raise(NotImplementedError,
-                             f'UnKnown comparison operator `{op}`.')
-        if not v: return False
-        l = r
-      return True
-
-    case ast.BoolOp:
-      v = None
-      match type(et.op):
-        case ast.And:
-          for v in et.values:
-            v = ev(v)
-            if not v: return v
-        case ast.Or:
-          for v in et.values:
-            v = ev(v)
-            if v: return v
-        case _: ectx.Raise(NotImplementedError,
-                           f'Unknown boolean operator `{op}`.')
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+    ast.BitAnd: operator.and_,
+    ast.BitOr: operator.or_,
+    ast.BitXor: operator.xor,
+    ast.FloorDiv: operator.floordiv,
+    ast.LShift: operator.lshift,
+    ast.RShift: operator.rshift,
+}
+_UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+    ast.Not: operator.not_,
+    ast.Invert: operator.invert,
+}
+_COMPARE_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.In: lambda l, r: l in r,
+    ast.NotIn: lambda l, r: l not in r,
+}
+
+
+def _EvalAstExpression(et, ectx): return EvalGclAst(et.body, ectx)
+
+
+def _EvalAstName(et, ectx):
+  res = _GclNameLookup(et.id, ectx)
+  while type(res) in _DEFERRED_TYPES: res = res._gcl_resolve_(ectx)
+  return res
+
+
+def _EvalAstConstant(et, ectx):
+  if isinstance(et.value, str):
+    return _ResolveStringValue(et.value, ectx)
+  return et.value
+
+
+def _EvalAstJoinedStr(et, ectx):
+  return ''.join(EvalGclAst(v, ectx) for v in et.values)
+
+
+def _EvalAstFormattedValue(et, ectx):
+  v = EvalGclAst(et.value, ectx)
+  match et.conversion:
+    case -1:  v = f'{v}'  # XXX: documentation does not say what this is
+    case 115: v = str(v)
+    case 114: v = repr(v)
+    case 97:  v = ascii(v)
+    case _: ectx.Raise(NotImplementedError,
+                       f'Unsupported Python conversion {et.conversion}')
+  if not et.format_spec: return v
+  return EvalGclAst(et.format_spec, ectx).format(v)
+
+
+def _EvalAstAttribute(et, ectx):
+  val = EvalGclAst(et.value, ectx)
+  builtin = _BUILTIN_NAMES.get(et.attr)
+  if builtin is not None:
+    with ectx.Scope(val): return builtin(ectx)
+  if isinstance(val, GclDict):
+    try: return val._gcl_traceable_get_(et.attr, ectx)
+    except KeyError: ectx.Raise(KeyError, f'No {et.attr} in this scope.')
+  try:
+    if isinstance(val, GclDict): return val[et.attr]
+    else: return getattr(val, et.attr)
+  except Exception as e:
+    ectx.Raise(KeyError, f'Cannot access attribute on value:\n  value'
+         f'({type(val).__name__}): {val}\n  attribute: {et.attr}\n', e)
+
+
+def _EvalAstBinOp(et, ectx):
+  l, r = EvalGclAst(et.left, ectx), EvalGclAst(et.right, ectx)
+  op = _BINARY_OPERATORS.get(type(et.op))
+  if op: return op(l, r)
+  if type(et.op) is ast.MatMult: return _CompositeGclTuples([l, r], ectx)
+  ectx.Raise(NotImplementedError,
+             f'Unsupported binary operator `{type(et.op).__name__}`.')
+
+
+def _EvalAstUnaryOp(et, ectx):
+  op = _UNARY_OPERATORS.get(type(et.op))
+  if op: return op(EvalGclAst(et.operand, ectx))
+  ectx.Raise(NotImplementedError,
+             f'Unsupported unary operator `{type(et.op).__name__}`.')
+
+
+def _EvalAstCompare(et, ectx):
+  l = EvalGclAst(et.left, ectx)
+  for op, r in zip(et.ops, et.comparators):
+    r = EvalGclAst(r, ectx)
+    cmp = _COMPARE_OPERATORS.get(type(op))
+    if cmp is None: ectx.Raise(NotImplementedError,
+                               f'UnKnown comparison operator `{op}`.')
+    if not cmp(l, r): return False
+    l = r
+  return True
+
+
+def _EvalAstBoolOp(et, ectx):
+  v = None
+  op = type(et.op)
+  if op is ast.And:
+    for v in et.values:
+      v = EvalGclAst(v, ectx)
+      if not v: return v
+  elif op is ast.Or:
+    for v in et.values:
+      v = EvalGclAst(v, ectx)
+      if v: return v
+  else: ectx.Raise(NotImplementedError,
+                   f'Unknown boolean operator `{op.__name__}`.')
+  return v
+
+
+def _EvalAstIfExp(et, ectx):
+  if EvalGclAst(et.test, ectx): return EvalGclAst(et.body, ectx)
+  return EvalGclAst(et.orelse, ectx)
+
+
+def _EvalAstCall(et, ectx):
+  fun, fun_name = None, None
+  if isinstance(et.func, ast.Name):
+    fun_name = et.func.id
+    fun = ectx.opts.functions.get(fun_name)
+    if fun is None: fun = _BUILTIN_FUNCS.get(fun_name)
+  if not fun:
+    fun = EvalGclAst(et.func, ectx)
+  if isinstance(fun, GclLambda): fun = fun.Callable(fun_name, ectx)
+  if not callable(fun): ectx.Raise(
+      TypeError, f'`{fun_name or ast.unparse(et.func)}` is not a function.')
+  if isinstance(fun, ArgumentDeferringFunction):
+    return fun(ectx, *et.args, **{kw.arg: kw.value for kw in et.keywords})
+  fun_args = [EvalGclAst(arg, ectx) for arg in et.args]
+  fun_kwargs = ({kw.arg: EvalGclAst(kw.value, ectx) for kw in et.keywords}
+                if et.keywords else {})
+  try: return fun(*fun_args, **fun_kwargs)
+  except Exception as e:
+    if isinstance(e, YamletBaseException): raise
+    ectx.Raise(type(e),
+        f'An exception occurred during a Yamlet call to a function '
+        f'`{fun.__name__}`: {e}', e)
+
+
+def _EvalAstSubscript(et, ectx):
+  v = EvalGclAst(et.value, ectx)
+  if isinstance(et.slice, ast.Slice):
+    return v[et.slice.lower and EvalGclAst(et.slice.lower, ectx)
+            :et.slice.upper and EvalGclAst(et.slice.upper, ectx)]
+  return v[EvalGclAst(et.slice, ectx)]
+
+
+def _EvalAstList(et, ectx): return [EvalGclAst(x, ectx) for x in et.elts]
+def _EvalAstTuple(et, ectx): return tuple(EvalGclAst(x, ectx) for x in et.elts)
+def _EvalAstSet(et, ectx): return set(EvalGclAst(x, ectx) for x in et.elts)
+
+
+def _EvalAstDict(et, ectx):
+  def EvalKey(k):
+    if isinstance(k, ast.Name): return k.id
+    if isinstance(k, ast.Constant):
+      if isinstance(k.value, str):
+        return _ResolveStringValue(k.value, ectx)
+      return k.value
+    ectx.Raise(KeyError, 'Yamlet keys should be names or strings. '
+                         f'Got `{type(k).__name__}`:\n{k}')
+  children = []
+  def DeferAst(v):
+    if isinstance(v, ast.Dict):
+      v = EvalGclAst(v, ectx)
+      children.append(v)
       return v
+    return ParsedExpressionToEvaluate(v, ectx.GetPoint())
+  res = ectx.NewGclDict({EvalKey(k): DeferAst(v)
+                         for k,v in zip(et.keys, et.values)})
+  _UpdateParents(children, res)
+  return res
 
-    case ast.IfExp:
-      return ev(et.body) if ev(et.test) else ev(et.orelse)
-
-    case ast.Call:
-      fun, fun_name = None, None
-      if isinstance(et.func, ast.Name):
-        fun_name = et.func.id
-        if fun_name in ectx.opts.functions: fun = ectx.opts.functions[fun_name]
-        elif fun_name in _BUILTIN_FUNCS: fun = _BUILTIN_FUNCS[fun_name]
-      if not fun:
-        fun = EvalGclAst(et.func, ectx)
-      if isinstance(fun, GclLambda): fun = fun.Callable(fun_name, ectx)
-      if not callable(fun): ectx.Raise(
-          TypeError, f'`{fun_name or ast.unparse(et.func)}` is not a function.')
-      fun_args, fun_kwargs = et.args, {kw.arg: kw.value for kw in et.keywords}
-      if isinstance(fun, ArgumentDeferringFunction):
-        return fun(ectx, *fun_args, **fun_kwargs)
-      fun_args = [EvalGclAst(arg, ectx) for arg in fun_args]
-      fun_kwargs = {k: EvalGclAst(v, ectx) for k, v in fun_kwargs.items()}
-      try: return fun(*fun_args, **fun_kwargs)
-      except Exception as e:
-        if isinstance(e, YamletBaseException): raise
-        ectx.Raise(type(e),
-            f'An exception occurred during a Yamlet call to a function '
-            f'`{fun.__name__}`: {e}', e)
-
-    case ast.Subscript:
-      v = ev(et.value)
-      if isinstance(et.slice, ast.Slice):
-        return v[et.slice.lower and ev(et.slice.lower)
-                :et.slice.upper and ev(et.slice.upper)]
-      return v[ev(et.slice)]
-
-    case ast.List:
-      return [ev(x) for x in et.elts]
-
-    case ast.Tuple:
-      return tuple(ev(x) for x in et.elts)
-
-    case ast.Set:
-      return set(ev(elt) for elt in et.elts)
-
-    case ast.Dict:
-      def EvalKey(k):
-        if isinstance(k, ast.Name): return k.id
-        if isinstance(k, ast.Constant):
-          if isinstance(k.value, str):
-            return _ResolveStringValue(k.value, ectx)
-          return k.value
-        ectx.Raise(KeyError, 'Yamlet keys should be names or strings. '
-                             f'Got `{type(k).__name__}`:\n{k}')
-      children = []
-      def DeferAst(v):
-        if isinstance(v, ast.Dict):
-          v = ev(v)
-          children.append(v)
-          return v
-        return ExpressionToEvaluate(ast.unparse(v), ectx.GetPoint())
-      res = ectx.NewGclDict({EvalKey(k): DeferAst(v)
-                             for k,v in zip(et.keys, et.values)})
-      _UpdateParents(children, res)
-      return res
 
-    case ast.GeneratorExp:
-      return _EvalComprehension(et.elt, et.generators, ectx)
-    case ast.ListComp:
-      return list(_EvalComprehension(et.elt, et.generators, ectx))
-    case ast.SetComp:
-      return set(_EvalComprehension(et.elt, et.generators, ectx))
-    case ast.DictComp:
-      return dict(_EvalComprehension(ast.Tuple([et.key, et.value]),
-                                     et.generators, ectx))
+def _EvalAstGeneratorExp(et, ectx):
+  return _EvalComprehension(et.elt, et.generators, ectx)
+def _EvalAstListComp(et, ectx):
+  return list(_EvalComprehension(et.elt, et.generators, ectx))
+def _EvalAstSetComp(et, ectx):
+  return set(_EvalComprehension(et.elt, et.generators, ectx))
+def _EvalAstDictComp(et, ectx):
+  return dict(_EvalComprehension(ast.Tuple([et.key, et.value]),
+                                 et.generators, ectx))
+
+
+# Maps each supported Python AST node type to the function that evaluates it.
+_AST_EVALUATORS = {
+    ast.Expression: _EvalAstExpression,
+    ast.Name: _EvalAstName,
+    ast.Constant: _EvalAstConstant,
+    ast.JoinedStr: _EvalAstJoinedStr,
+    ast.FormattedValue: _EvalAstFormattedValue,
+    ast.Attribute: _EvalAstAttribute,
+    ast.BinOp: _EvalAstBinOp,
+    ast.UnaryOp: _EvalAstUnaryOp,
+    ast.Compare: _EvalAstCompare,
+    ast.BoolOp: _EvalAstBoolOp,
+    ast.IfExp: _EvalAstIfExp,
+    ast.Call: _EvalAstCall,
+    ast.Subscript: _EvalAstSubscript,
+    ast.List: _EvalAstList,
+    ast.Tuple: _EvalAstTuple,
+    ast.Set: _EvalAstSet,
+    ast.Dict: _EvalAstDict,
+    ast.GeneratorExp: _EvalAstGeneratorExp,
+    ast.ListComp: _EvalAstListComp,
+    ast.SetComp: _EvalAstSetComp,
+    ast.DictComp: _EvalAstDictComp,
+}
+
 
+def EvalGclAst(et, ectx):
+  evaluator = _AST_EVALUATORS.get(type(et))
+  if evaluator: return evaluator(et, ectx)
   ectx.Raise(NotImplementedError,
              f'Undefined Yamlet operation `{type(et).__name__}`')
 
 
+def _ShadowedValues(tuples):
+  '''Finds keys that the given tuples only ever assign plain values.
+
+  When these tuples are merged over a clone of another tuple, that tuple's
+  values for these keys would be cloned just to be overwritten. The clone can
+  take the final value up front instead.
+  '''
+  shadowed, mixed = {}, set()
+  for t in tuples:
+    for k, v in t._gcl_noresolve_items_():
+      if (isinstance(v, Cloneable) or
+          v is null or v is external or v is _undefined): mixed.add(k)
+      else: shadowed[k] = v
+  for k in mixed: shadowed.pop(k, None)
+  return shadowed
+
+
 def _CompositeGclTuples(tuples, ectx):
   res = None
-  for t in tuples:
+  for i, t in enumerate(tuples):
     if t is None: ectx.Raise(ValueError, 'Expression evaluation failed?')
     if res: res.yamlet_merge(t, ectx)
+    elif all(isinstance(u, (GclDict, PreprocessingTuple)) for u in tuples[i:]):
+      res = t.yamlet_clone(ectx.scope, ectx,
+                           shadowed=_ShadowedValues(tuples[i + 1:]))
     else:   res = t.yamlet_clone(ectx.scope, ectx)
   return res